@@ -4,114 +4,237 @@
 # Thư viện chuẩn Python 3.12.
 
 import argparse
-import email
+from array import array
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache
 from email.header import decode_header, make_header
 import hashlib
 import imaplib
+from itertools import repeat
+import multiprocessing
+import os
+import queue
+import re
 import sqlite3
 import sys
+import threading
 import time
 from datetime import datetime
-from typing import Any, List, Tuple, Optional
-
-# Tránh "line too long" khi FETCH nhiều header
-import imaplib as _imaplib
-_imaplib._MAXLINE = max(10_000_000, getattr(_imaplib, "_MAXLINE", 0))
+from typing import Any, Iterator, List, Sequence, Tuple, Optional
 
 HEADER_FIELDS = ["Message-ID", "Date", "From", "To", "Subject"]
+# Chỉ lấy N byte đầu của khối header; đủ cho 5 trường ngắn ở gần như mọi thư
+HEADER_PEEK_BYTES = 8192
+# Regex biên dịch sẵn, chạy thẳng trên meta bytes của FETCH (không decode)
+_META_RE = re.compile(rb"UID\s+(\d+).*?RFC822\.SIZE\s+(\d+)", re.DOTALL)
+_UID_RE = re.compile(rb"UID\s+(\d+)")
+_SIZE_RE = re.compile(rb"RFC822\.SIZE\s+(\d+)")
+_WS_RE = re.compile(rb"\s+")
+# Kết quả FETCH của một batch dạng SoA: (uids, sizes, raw_headers) song song theo chỉ số,
+# tránh tạo một tuple cho mỗi thư
+FetchedBatch = Tuple[array, array, List[bytes]]
+_WANTED_HEADERS = {f.lower().encode("ascii"): f for f in HEADER_FIELDS}
+# Giữ dưới giới hạn 999 tham số/câu lệnh của các bản SQLite cũ
+SQL_IN_CHUNK = 900
+# Số batch tối đa dồn chung một transaction SQLite khi không có gì cần STORE
+COMMIT_EVERY_BATCHES = 10
+# Tăng khi cách tính digest hoặc schema thay đổi; DB cũ sẽ được tạo lại
+SCHEMA_VERSION = 6
 SQL_SCHEMA = """
 CREATE TABLE IF NOT EXISTS seen_hashes (
   mailbox TEXT NOT NULL,
-  digest  TEXT NOT NULL,
+  digest  BLOB NOT NULL,
   keep_uid INTEGER NOT NULL,
   PRIMARY KEY (mailbox, digest)
-);
-CREATE INDEX IF NOT EXISTS idx_seen_hashes_mailbox ON seen_hashes(mailbox);
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS seen_msgids (
+  mailbox TEXT NOT NULL,
+  msgid   BLOB NOT NULL,
+  keep_uid INTEGER NOT NULL,
+  PRIMARY KEY (mailbox, msgid)
+) WITHOUT ROWID;
 """
+# Tải chủ yếu là INSERT; WAL + synchronous=NORMAL giảm fsync, cache/mmap lớn giữ index trong RAM
+SQL_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-262144",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+]
+# Bảng lưu khóa dedupe -> cột khóa: Message-ID chuẩn hóa lưu nguyên văn, tổ hợp header lưu digest
+KEY_TABLES = {"seen_msgids": "msgid", "seen_hashes": "digest"}
 
 def imap_date(d: str) -> str:
     dt = datetime.strptime(d, "%Y-%m-%d")
     return dt.strftime("%d-%b-%Y")
 
-def normalize(s: Any) -> str:
+def normalize(s: Any) -> bytes:
+    if isinstance(s, bytes) and b"=?" not in s:
+        # đường nhanh cho header thường (không có encoded word): không decode, không regex
+        return b" ".join(s.split()).lower()
     if s is None:
-        text = ""
+        text = b""
     elif isinstance(s, (bytes, bytearray)):
-        text = s.decode("utf-8", "ignore")
+        text = bytes(s)
     else:
-        text = str(s)
-
-    try:
-        # email headers may contain RFC 2047 encoded words; decode them for stable hashing
-        text = str(make_header(decode_header(text)))
-    except Exception:
-        pass
+        text = str(s).encode("utf-8", "ignore")
 
-    return " ".join(text.strip().split())
-
-def hash_key(msgid: str, date: str, from_: str, to: str, subject: str, size: int) -> str:
-    if msgid:
-        basis = f"MID:{normalize(msgid).lower()}"
-    else:
-        basis = "|".join([
-            f"F:{normalize(from_).lower()}",
-            f"T:{normalize(to).lower()}",
-            f"S:{normalize(subject).lower()}",
-            f"D:{normalize(date)}",
-            f"Z:{size}",
-        ])
-    return hashlib.sha256(basis.encode("utf-8", "ignore")).hexdigest()
+    if b"=?" in text:
+        try:
+            # email headers may contain RFC 2047 encoded words; decode them for stable hashing
+            text = str(make_header(decode_header(text.decode("utf-8", "ignore")))).encode("utf-8", "ignore")
+        except Exception:
+            pass
 
-def parse_headers(raw_bytes: bytes):
-    msg = email.message_from_bytes(raw_bytes)
-    g = lambda k: msg.get(k, "") or ""
+    return _WS_RE.sub(b" ", text.strip()).lower()
+
+@lru_cache(maxsize=65536)
+def normalize_address(s: bytes) -> bytes:
+    # From/To lặp lại rất nhiều giữa các thư (cùng người gửi/nhận); cache kết quả chuẩn hóa
+    return normalize(s)
+
+def msgid_key(msgid: Any) -> bytes:
+    # Message-ID đã là định danh duy nhất, chỉ cần chuẩn hóa, không cần băm
+    return normalize(msgid)
+
+def composite_key(date: Any, from_: Any, to: Any, subject: Any, size: int) -> bytes:
+    basis = b"|".join([
+        b"F:" + normalize_address(from_),
+        b"T:" + normalize_address(to),
+        b"S:" + normalize(subject),
+        b"D:" + normalize(date),
+        b"Z:%d" % size,
+    ])
+    # digest chỉ dùng làm khóa dedupe nội bộ, không cần hàm băm mật mã chậm; 128 bit là đủ.
+    # Giữ 16 byte thô (không hex) để SQLite lưu BLOB, index nhỏ hơn và so sánh bằng memcmp.
+    return hashlib.blake2b(basis, digest_size=16).digest()
+
+def parse_headers_fast(raw: bytes, truncated: bool = False) -> dict:
+    # Tách header thủ công thay vì dựng cả email.message: chỉ lấy 5 trường cần, giữ nguyên bytes.
+    # truncated=True: caller biết khối đã chạm giới hạn partial FETCH, header cuối có thể chưa đủ.
+    found = {}
+    cur = None
+    cur_name = None
+    for line in raw.splitlines():
+        if not line:
+            break
+        if line[0] in b" \t":
+            # dòng gấp (folded) nối vào header đang đọc
+            if cur is not None:
+                cur.append(line)
+            continue
+        cur = None
+        i = line.find(b":")
+        if i <= 0:
+            continue
+        name = line[:i].strip().lower()
+        if name in _WANTED_HEADERS and name not in found:
+            cur = found[name] = [line[i + 1:]]
+            cur_name = name
+    if truncated and cur is not None:
+        # header đang đọc dở khi hết dữ liệu: bỏ đi, caller sẽ FETCH lại đầy đủ
+        del found[cur_name]
     return {
-        "Message-ID": g("Message-ID"),
-        "Date": g("Date"),
-        "From": g("From"),
-        "To": g("To"),
-        "Subject": g("Subject"),
+        field: b"".join(found[name]).strip() if name in found else b""
+        for name, field in _WANTED_HEADERS.items()
     }
 
-def chunk_iter(lst: List[int], size: int):
-    for i in range(0, len(lst), size):
-        yield lst[i:i+size]
-
-def safe_split_fetch_data(data):
-    # imaplib trả về list hỗn hợp tuple/bytes; chuẩn hóa về các cặp (meta_str, payload_bytes)
-    out = []
-    i = 0
-    while i < len(data):
-        part = data[i]
-        if isinstance(part, tuple) and len(part) >= 2:
-            meta = part[0]
-            payl = part[1]
-            meta_str = meta.decode("utf-8", "ignore") if isinstance(meta, (bytes, bytearray)) else str(meta)
-            if isinstance(payl, (bytes, bytearray)):
-                out.append((meta_str, payl))
-        i += 1
-    return out
-
-def extract_uid_and_size(meta_str: str) -> Tuple[Optional[int], Optional[int]]:
-    uid = None
-    size = None
-    toks = meta_str.replace("(", " ").replace(")", " ").split()
-    for j, t in enumerate(toks):
-        if t == "UID" and j + 1 < len(toks):
-            try:
-                uid = int(toks[j + 1])
-            except Exception:
-                pass
-        if t == "RFC822.SIZE" and j + 1 < len(toks):
-            try:
-                size = int(toks[j + 1])
-            except Exception:
-                pass
-    return uid, size
+def compute_digest(hdr_bytes: bytes, size: int, criteria: str) -> Tuple[str, bytes]:
+    # Phần thuần tính toán cho một thư (parse + khóa), không đụng IMAP/SQLite; trả (bảng, khóa) theo KEY_TABLES.
+    # Hàm top-level để có thể chạy trong ProcessPoolExecutor.
+    h = parse_headers_fast(hdr_bytes)
+    key = msgid_key(h["Message-ID"]) if criteria != "composite_only" and h["Message-ID"] else b""
+    if key:
+        return "seen_msgids", key
+    return "seen_hashes", composite_key(h["Date"], h["From"], h["To"], h["Subject"], size)
+
+def digest_batch(headers: FetchedBatch, criteria: str, executor: Optional[Executor] = None) -> List[Tuple[int, str, bytes]]:
+    uids, sizes, raw_headers = headers
+    # Một cài đặt duy nhất (compute_digest) cho cả hai đường để khóa luôn khớp dù chạy --workers bao nhiêu
+    if executor is None:
+        keyed = map(compute_digest, raw_headers, sizes, repeat(criteria))
+    else:
+        keyed = executor.map(compute_digest, raw_headers, sizes, repeat(criteria), chunksize=256)
+    return [(uid, table, key) for uid, (table, key) in zip(uids, keyed)]
+
+def chunk_iter(seq, size: int):
+    # Với array UID, cắt trên memoryview: mỗi batch là một view trên cùng bộ nhớ, không copy ra list mới
+    view = memoryview(seq) if isinstance(seq, array) else seq
+    for i in range(0, len(view), size):
+        yield view[i:i+size]
+
+def to_uid_set(uids) -> str:
+    # Gộp các UID liên tiếp thành dải lo:hi, ví dụ [100,101,102,200,201] -> "100:102,200:201"
+    parts = []
+    lo = hi = None
+    for uid in sorted(set(uids)):
+        if hi is not None and uid == hi + 1:
+            hi = uid
+            continue
+        if lo is not None:
+            parts.append(f"{lo}:{hi}" if hi != lo else str(lo))
+        lo = hi = uid
+    if lo is not None:
+        parts.append(f"{lo}:{hi}" if hi != lo else str(lo))
+    return ",".join(parts)
+
+def iter_fetch_items(data) -> Iterator[Tuple[int, int, bytes]]:
+    # Một lượt duy nhất trên phản hồi FETCH của imaplib (list hỗn hợp tuple/bytes):
+    # mỗi cặp (meta, literal) -> (uid, size, header bytes), không decode, không copy, không list trung gian.
+    meta_search = _META_RE.search
+    for part in data:
+        if not isinstance(part, tuple) or len(part) < 2:
+            continue
+        meta, payl = part[0], part[1]
+        if not isinstance(meta, bytes) or not isinstance(payl, bytes):
+            continue
+        m = meta_search(meta)
+        if m:
+            yield int(m[1]), int(m[2]), payl
+            continue
+        # server trả RFC822.SIZE trước UID
+        m_uid = _UID_RE.search(meta)
+        m_size = _SIZE_RE.search(meta)
+        if m_uid and m_size:
+            yield int(m_uid[1]), int(m_size[1]), payl
+
+class _BufferedReadMixin:
+    # imaplib mặc định đọc qua buffer 8 KiB và giới hạn dòng bằng _MAXLINE toàn cục.
+    # Dùng buffer 1 MiB (BufferedReader -> recv_into, tìm CRLF bằng memchr trong C) và giới hạn
+    # dòng riêng, đủ cho SEARCH trả về hàng triệu UID, không phải vá module imaplib.
+    READ_BUFFER = 1 << 20
+    MAX_LINE = 10_000_000
+
+    def open(self, *args, **kwargs):
+        super().open(*args, **kwargs)
+        self._rewrap_file()
+
+    def starttls(self, *args, **kwargs):
+        result = super().starttls(*args, **kwargs)
+        self._rewrap_file()
+        return result
+
+    def _rewrap_file(self):
+        self.file.close()
+        self.file = self.sock.makefile("rb", buffering=self.READ_BUFFER)
+
+    def readline(self):
+        line = self.file.readline(self.MAX_LINE + 1)
+        if len(line) > self.MAX_LINE:
+            raise self.error(f"got more than {self.MAX_LINE} bytes")
+        return line
+
+class BufferedIMAP4(_BufferedReadMixin, imaplib.IMAP4):
+    pass
+
+class BufferedIMAP4_SSL(_BufferedReadMixin, imaplib.IMAP4_SSL):
+    pass
 
 class ImapSession:
-    def __init__(self, args):
+    def __init__(self, args, readonly: bool = False):
         self.args = args
+        self.readonly = readonly
         self.M: Optional[imaplib.IMAP4] = None
         self.connect()
 
@@ -122,9 +245,9 @@ class ImapSession:
             except Exception:
                 pass
         if not self.args.no_ssl:
-            self.M = imaplib.IMAP4_SSL(self.args.host, self.args.port, timeout=self.args.timeout)
+            self.M = BufferedIMAP4_SSL(self.args.host, self.args.port, timeout=self.args.timeout)
         else:
-            self.M = imaplib.IMAP4(self.args.host, self.args.port, timeout=self.args.timeout)
+            self.M = BufferedIMAP4(self.args.host, self.args.port, timeout=self.args.timeout)
             if self.args.starttls:
                 self.M.starttls()
         typ, _ = self.M.login(self.args.user, self.args.password)
@@ -133,7 +256,7 @@ class ImapSession:
         self.select_mailbox(self.args.mailbox)
 
     def select_mailbox(self, mailbox: str):
-        typ, data = self.M.select(mailbox, readonly=False)
+        typ, data = self.M.select(mailbox, readonly=self.readonly)
         if typ != "OK":
             raise RuntimeError(f"Cannot select mailbox {mailbox}: {data}")
 
@@ -145,6 +268,22 @@ class ImapSession:
             self.connect()
             return self.M.uid(*cmd)
 
+    def pipeline_uid(self, *cmds) -> Tuple[List[str], List[Any]]:
+        # Gửi liên tiếp nhiều lệnh UID rồi mới đọc kết quả, tránh chờ 1 RTT cho mỗi lệnh.
+        # Phản hồi FETCH untagged được gộp chung; mỗi mục đều mang UID nên caller tự tách.
+        try:
+            return self._pipeline_uid(cmds)
+        except imaplib.IMAP4.abort:
+            # reconnect and retry once
+            self.connect()
+            return self._pipeline_uid(cmds)
+
+    def _pipeline_uid(self, cmds) -> Tuple[List[str], List[Any]]:
+        tags = [self.M._command("UID", *cmd) for cmd in cmds]
+        typs = [self.M._command_complete("UID", tag)[0] for tag in tags]
+        _, data = self.M._untagged_response("OK", [None], "FETCH")
+        return typs, data
+
     def noop(self):
         try:
             self.M.noop()
@@ -160,7 +299,7 @@ class ImapSession:
             self.connect()
             self.M.expunge()
 
-def search_uids(session: ImapSession, since: str, before: str) -> List[int]:
+def search_uids(session: ImapSession, since: str, before: str) -> array:
     crit = ["ALL"]
     if since:
         crit += ["SINCE", imap_date(since)]
@@ -170,63 +309,174 @@ def search_uids(session: ImapSession, since: str, before: str) -> List[int]:
     if typ != "OK":
         raise RuntimeError(f"SEARCH failed: {data}")
     raw = data[0] or b""
-    return list(map(int, raw.split())) if raw else []
-
-def fetch_headers_sizes(session: ImapSession, uids: List[int]) -> List[Tuple[int, bytes, int]]:
-    if not uids:
-        return []
-    seq = ",".join(map(str, uids))
+    # UID là số 32 bit không dấu (RFC 3501); giữ trong array thay vì list các int object
+    return array("I", map(int, raw.split()))
+
+def fetch_headers_sizes(session: ImapSession, uids: Sequence[int], partial: bool = True) -> FetchedBatch:
+    return fetch_headers_sizes_pipelined(session, [uids], partial)[0]
+
+def fetch_headers_sizes_pipelined(session: ImapSession, batches: List[Sequence[int]], partial: bool = True) -> List[FetchedBatch]:
+    # Một lệnh FETCH cho mỗi batch, gửi cùng lúc; kết quả trả về theo đúng thứ tự batch
+    out: List[FetchedBatch] = [(array("Q"), array("Q"), []) for _ in batches]
+    batches_idx = [i for i, b in enumerate(batches) if b]
+    if not batches_idx:
+        return out
+    owner = {uid: i for i in batches_idx for uid in batches[i]}
+    section = f"<0.{HEADER_PEEK_BYTES}>" if partial else ""
     session.noop()
-    typ, data = session.safe_uid(
-        "FETCH",
-        seq,
-        f'(RFC822.SIZE BODY.PEEK[HEADER.FIELDS ({" ".join(HEADER_FIELDS)})])',
-    )
-    if typ != "OK":
-        raise RuntimeError(f"FETCH failed for {len(uids)} uids")
-    out = []
-    for meta_str, hdr_bytes in safe_split_fetch_data(data or []):
-        uid, size = extract_uid_and_size(meta_str)
-        if uid is not None and size is not None:
-            out.append((uid, hdr_bytes, size))
+    typs, data = session.pipeline_uid(*[
+        (
+            "FETCH",
+            to_uid_set(batches[i]),
+            f'(RFC822.SIZE BODY.PEEK[HEADER.FIELDS ({" ".join(HEADER_FIELDS)})]{section})',
+        )
+        for i in batches_idx
+    ])
+    for i, typ in zip(batches_idx, typs):
+        if typ != "OK":
+            raise RuntimeError(f"FETCH failed for {len(batches[i])} uids")
+    for uid, size, hdr_bytes in iter_fetch_items(data or []):
+        if uid in owner:
+            uids, sizes, raw_headers = out[owner[uid]]
+            uids.append(uid)
+            sizes.append(size)
+            raw_headers.append(hdr_bytes)
+
+    if partial:
+        # Khối header chạm giới hạn và thiếu trường: có thể trường đó bị cắt, FETCH lại đầy đủ.
+        # Khối chạm giới hạn mà vẫn đủ trường thì không còn header đọc dở, parse thường cho cùng kết quả.
+        truncated = [
+            uid
+            for uids, _, raw_headers in out
+            for uid, hdr_bytes in zip(uids, raw_headers)
+            if len(hdr_bytes) >= HEADER_PEEK_BYTES and not all(parse_headers_fast(hdr_bytes, truncated=True).values())
+        ]
+        if truncated:
+            full_uids, _, full_headers = fetch_headers_sizes(session, truncated, partial=False)
+            full = dict(zip(full_uids, full_headers))
+            for uids, _, raw_headers in out:
+                for j, uid in enumerate(uids):
+                    if uid in full:
+                        raw_headers[j] = full[uid]
     return out
 
-def _chunks(uids, n=500):
-    for i in range(0, len(uids), n):
-        yield uids[i:i+n]
+def iter_fetched_batches(session: ImapSession, uids: Sequence[int], chunk: int, depth: int):
+    # Lấy trước `depth` batch trong một lượt pipeline, sau đó trả từng batch cho vòng xử lý
+    batches = list(chunk_iter(uids, chunk))
+    for group in chunk_iter(batches, max(1, depth)):
+        for batch, headers in zip(group, fetch_headers_sizes_pipelined(session, group)):
+            yield batch, headers
+
+_PREFETCH_DONE = object()
+
+def iter_prefetched_batches(args, uids: Sequence[int], chunk: int, depth: int):
+    # Luồng phụ dùng kết nối IMAP thứ hai (EXAMINE, chỉ đọc) FETCH trước các batch kế tiếp,
+    # trong khi luồng chính băm/ghi SQLite/STORE batch hiện tại trên kết nối chính.
+    q: "queue.Queue[Any]" = queue.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        session = None
+        try:
+            session = ImapSession(args, readonly=True)
+            for item in iter_fetched_batches(session, uids, chunk, depth):
+                if not put(item):
+                    return
+            put(_PREFETCH_DONE)
+        except Exception as exc:
+            put(exc)
+        finally:
+            if session is not None:
+                try:
+                    session.M.logout()
+                except Exception:
+                    pass
+
+    threading.Thread(target=producer, name="imap-prefetch", daemon=True).start()
+    try:
+        while True:
+            item = q.get()
+            if item is _PREFETCH_DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
 
-def mark_delete(session: ImapSession, uids: List[int], store_chunk: int):
+def mark_delete(session: ImapSession, uids: List[int], store_chunk: int, depth: int = 1):
     if not uids:
         return
-    for part in _chunks(uids, store_chunk):
-        seq = ",".join(map(str, part))
+    parts = list(chunk_iter(uids, store_chunk))
+    for group in chunk_iter(parts, max(1, depth)):
         session.noop()
-        typ, _ = session.safe_uid("STORE", seq, "+FLAGS.SILENT", r"(\Deleted)")
-        if typ != "OK":
+        typs, _ = session.pipeline_uid(*[
+            ("STORE", to_uid_set(part), "+FLAGS.SILENT", r"(\Deleted)")
+            for part in group
+        ])
+        if any(typ != "OK" for typ in typs):
             raise RuntimeError("STORE +FLAGS.SILENT \\Deleted failed")
 
-def filter_undeleted(session: ImapSession, uids: List[int], fetch_flags_chunk: int) -> List[int]:
+def filter_undeleted(session: ImapSession, uids: List[int], fetch_flags_chunk: int, depth: int = 1) -> List[int]:
     # Loại các UID đã có \Deleted để tránh đánh dấu lại khi resume sau reconnect
     remain = []
-    for part in _chunks(uids, fetch_flags_chunk):
-        seq = ",".join(map(str, part))
+    wanted = set(uids)
+    parts = list(chunk_iter(uids, fetch_flags_chunk))
+    for group in chunk_iter(parts, max(1, depth)):
         session.noop()
-        typ, data = session.safe_uid("FETCH", seq, "(UID FLAGS)")
-        if typ != "OK":
-            continue
-        it = iter(data or [])
-        for item in it:
-            if not isinstance(item, tuple) or len(item) < 2:
+        _, data = session.pipeline_uid(*[
+            ("FETCH", to_uid_set(part), "(UID FLAGS)")
+            for part in group
+        ])
+        for item in data or []:
+            # FETCH (UID FLAGS) không có literal nên imaplib trả bytes thay vì tuple
+            if isinstance(item, tuple):
+                item = item[0]
+            if not isinstance(item, (bytes, bytearray)):
+                continue
+            m = _UID_RE.search(item)
+            if m is None:
                 continue
-            meta = item[0].decode("utf-8", "ignore") if isinstance(item[0], (bytes, bytearray)) else str(item[0])
-            uid, _ = extract_uid_and_size(meta.replace("RFC822.SIZE", "X"))  # bỏ SIZE nếu có
-            flags_bytes = item[1] if isinstance(item[1], (bytes, bytearray)) else b""
-            deleted = b"\\Deleted" in flags_bytes
-            if uid and not deleted:
+            uid = int(m[1])
+            deleted = b"\\Deleted" in item
+            if uid in wanted and not deleted:
                 remain.append(uid)
     return remain
 
+def lookup_keep_uids(cur: sqlite3.Cursor, table: str, mailbox: str, keys: List[bytes]) -> dict:
+    column = KEY_TABLES[table]
+    existing = {}
+    for part in chunk_iter(list(dict.fromkeys(keys)), SQL_IN_CHUNK):
+        rows = cur.execute(
+            f"SELECT {column}, keep_uid FROM {table} WHERE mailbox=? AND {column} IN ({','.join('?' * len(part))})",
+            (mailbox, *part),
+        )
+        existing.update(rows)
+    return existing
+
+def tune_db(db: sqlite3.Connection):
+    for pragma in SQL_PRAGMAS:
+        db.execute(pragma)
+
 def ensure_schema(db: sqlite3.Connection):
+    (version,) = db.execute("PRAGMA user_version").fetchone()
+    if version != SCHEMA_VERSION:
+        # Digest cũ không so khớp được với digest mới; xóa trạng thái và tính lại từ đầu.
+        # An toàn: thư đã giữ vẫn còn trên server và sẽ được ghi nhận lại ở lần chạy này.
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='seen_hashes'").fetchone():
+            print(f"SQLite state uses an older digest format (v{version}); resetting it.")
+        for table in KEY_TABLES:
+            db.execute(f"DROP TABLE IF EXISTS {table}")
+        db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     for stmt in SQL_SCHEMA.strip().split(";"):
         s = stmt.strip()
         if s:
@@ -247,6 +497,12 @@ def main():
     ap.add_argument("--chunk", type=int, default=3000, help="Batch size for UID list processing")
     ap.add_argument("--store-chunk", type=int, default=500, help="Batch size per UID STORE command")
     ap.add_argument("--fetch-flags-chunk", type=int, default=800, help="Batch size per FLAGS check when resuming")
+    ap.add_argument("--pipeline", type=int, default=4,
+                    help="Number of UID FETCH/STORE commands sent back-to-back before reading replies")
+    ap.add_argument("--prefetch", action="store_true",
+                    help="Fetch upcoming batches on a second IMAP connection while the current one is processed")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Processes used to compute digests (1 = in-process, 0 = one per CPU core)")
     ap.add_argument("--sleep", type=float, default=0.0, help="Sleep seconds between batches")
     ap.add_argument("--timeout", type=int, default=120, help="Socket timeout for IMAP operations")
     ap.add_argument("--db", default="imap_dedupe.sqlite3")
@@ -258,12 +514,20 @@ def main():
 
     # DB
     db = sqlite3.connect(args.db)
+    tune_db(db)
     ensure_schema(db)
     cur = db.cursor()
 
     # IMAP session
     session = ImapSession(args)
 
+    # Băm song song nhiều process; IMAP và SQLite vẫn chỉ ở process chính.
+    # Dùng spawn vì process chính có socket và có thể có luồng prefetch.
+    workers = args.workers or os.cpu_count() or 1
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
     try:
         uids = search_uids(session, args.since, args.before)
         total = len(uids)
@@ -274,55 +538,66 @@ def main():
         dupes_marked = 0
         batch_idx = 0
 
-        for batch in chunk_iter(uids, args.chunk):
+        # FETCH headers + size, pipeline nhiều batch mỗi lượt; --prefetch chạy FETCH song song trên kết nối thứ hai
+        if args.prefetch:
+            fetched = iter_prefetched_batches(args, uids, args.chunk, args.pipeline)
+        else:
+            fetched = iter_fetched_batches(session, uids, args.chunk, args.pipeline)
+        for batch, headers in fetched:
             batch_idx += 1
 
-            # FETCH headers + size
-            headers = fetch_headers_sizes(session, batch)
-
-            delete_uids = []
-            for uid, hdr_bytes, size in headers:
-                h = parse_headers(hdr_bytes)
-                if args.criteria == "composite_only":
-                    digest = hash_key("", h["Date"], h["From"], h["To"], h["Subject"], size)
-                else:
-                    digest = hash_key(h["Message-ID"], h["Date"], h["From"], h["To"], h["Subject"], size)
+            keys = digest_batch(headers, args.criteria, executor)
 
-                row = cur.execute(
-                    "SELECT keep_uid FROM seen_hashes WHERE mailbox=? AND digest=?",
-                    (args.mailbox, digest),
-                ).fetchone()
+            # Tra cả batch bằng vài câu SELECT ... IN, rồi phân loại trong bộ nhớ
+            if not db.in_transaction:
+                cur.execute("BEGIN IMMEDIATE")
+            existing = {
+                table: lookup_keep_uids(cur, table, args.mailbox, [k for _, t, k in keys if t == table])
+                for table in KEY_TABLES
+            }
 
-                if row is None:
-                    cur.execute(
-                        "INSERT OR REPLACE INTO seen_hashes(mailbox, digest, keep_uid) VALUES (?, ?, ?)",
-                        (args.mailbox, digest, uid),
-                    )
+            delete_uids = []
+            new_rows = {table: [] for table in KEY_TABLES}
+            for uid, table, key in keys:
+                seen = existing[table]
+                keep_uid = seen.get(key)
+                if keep_uid is None:
+                    # thư trùng trong cùng batch cũng phải thấy bản vừa giữ
+                    seen[key] = uid
+                    new_rows[table].append((args.mailbox, key, uid))
                     kept_new += 1
+                elif keep_uid == uid:
+                    kept_existing += 1  # this is the message we kept previously
                 else:
-                    keep_uid = row[0]
-                    if keep_uid == uid:
-                        kept_existing += 1
-                        continue  # this is the message we kept previously
                     delete_uids.append(uid)
 
-            db.commit()
+            # SELECT đã xác nhận các khóa này chưa có, OR IGNORE tránh delete+insert thừa của OR REPLACE
+            for table, rows in new_rows.items():
+                if rows:
+                    cur.executemany(
+                        f"INSERT OR IGNORE INTO {table}(mailbox, {KEY_TABLES[table]}, keep_uid) VALUES (?, ?, ?)",
+                        rows,
+                    )
+            # Commit trễ: dồn nhiều batch vào một transaction, nhưng luôn commit trước khi STORE
+            # để UID được giữ đã nằm trong SQLite trước khi bản trùng bị đánh dấu xóa
+            if (delete_uids and not args.dry_run) or batch_idx % COMMIT_EVERY_BATCHES == 0:
+                db.commit()
 
             if delete_uids:
                 if args.dry_run:
                     print(f"[Batch {batch_idx}] Would delete {len(delete_uids)} duplicates.")
                 else:
                     try:
-                        mark_delete(session, delete_uids, args.store_chunk)
+                        mark_delete(session, delete_uids, args.store_chunk, args.pipeline)
                         dupes_marked += len(delete_uids)
                         print(f"[Batch {batch_idx}] Marked {len(delete_uids)} duplicates as \\Deleted.")
                     except imaplib.IMAP4.abort:
                         # Reconnect và thử đánh dấu lại các UID chưa có \Deleted
                         print(f"[Batch {batch_idx}] STORE aborted. Reconnecting and resuming…")
                         session.connect()
-                        to_retry = filter_undeleted(session, delete_uids, args.fetch_flags_chunk)
+                        to_retry = filter_undeleted(session, delete_uids, args.fetch_flags_chunk, args.pipeline)
                         if to_retry:
-                            mark_delete(session, to_retry, args.store_chunk)
+                            mark_delete(session, to_retry, args.store_chunk, args.pipeline)
                             newly = len(to_retry)
                             dupes_marked += newly
                             print(f"[Batch {batch_idx}] Resumed. Marked additional {newly} as \\Deleted.")
@@ -339,6 +614,8 @@ def main():
             if args.sleep > 0:
                 time.sleep(args.sleep)
 
+        db.commit()
+
         if not args.dry_run:
             print("Final EXPUNGE…")
             try:
@@ -360,10 +637,16 @@ def main():
             )
 
     finally:
+        # Lưu các batch còn dồn trong transaction khi vòng lặp dừng giữa chừng (lỗi, Ctrl-C):
+        # mọi STORE đều đã commit trước, nên phần còn lại chỉ là các UID được giữ
+        if db.in_transaction:
+            db.commit()
         try:
             session.M.logout()
         except Exception:
             pass
+        if executor is not None:
+            executor.shutdown()
 
 if __name__ == "__main__":
     main()